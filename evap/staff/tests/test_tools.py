@@ -1,4 +1,5 @@
 from django.contrib.auth.models import Group
+from django.db.models import Count
 from django.test import TestCase
 from django.utils.html import escape
 from model_bakery import baker
@@ -13,195 +14,291 @@ from evap.staff.tools import (
     user_edit_link,
 )
 
+# some attributes we don't care about when merging
+_IGNORED_ATTRS = frozenset(
+    {
+        "id",  # nothing to merge here
+        "password",  # not used in production
+        "last_login",  # something to really not care about
+        "user_permissions",  # we don't use permissions
+        "logentry",  # wtf
+        "login_key",  # we decided to discard other_user's login key
+        "login_key_valid_until",  # not worth dealing with
+        "language",  # Not worth dealing with
+        "Evaluation_voters+",  # some more intermediate models, for an explanation see MergeUsersTest
+        "Evaluation_participants+",  # intermediate model
+        "startpage",  # not worth dealing with
+    }
+)
+
+# attributes that are handled in the merge method but that are not present in the merged_user dict
+# add attributes here only if you're actually dealing with them in merge_users().
+_ADDITIONAL_HANDLED = frozenset(
+    {
+        "grades_last_modified_user+",
+        "Course_responsibles+",
+    }
+)
+
 
 class MergeUsersTest(TestCase):
     @classmethod
     def setUpTestData(cls):
-        cls.user1 = baker.make(UserProfile, email="test1@institution.example.com")
-        cls.user2 = baker.make(UserProfile, email="test2@institution.example.com")
-        cls.user3 = baker.make(UserProfile, email="test3@institution.example.com")
-        cls.group1 = Group.objects.get(name="Reviewer")
-        cls.group2 = Group.objects.get(name="Grade publisher")
-        cls.main_user = baker.make(
+        cls.all_user_attrs = tuple(
+            field.name
+            for field in UserProfile._meta.get_fields(include_hidden=True)
+            # these are relations to intermediate models generated by django for m2m relations.
+            # we can safely ignore these since the "normal" fields of the m2m relations are present as well.
+            if not field.name.startswith("UserProfile_")
+        )
+
+    def test_merge_handles_all_attributes(self):
+        user1 = baker.make(UserProfile)
+        user2 = baker.make(UserProfile)
+
+        # equally named fields are not supported, sorry
+        self.assertEqual(len(self.all_user_attrs), len(set(self.all_user_attrs)))
+
+        expected_attrs = set(self.all_user_attrs) - _IGNORED_ATTRS
+
+        # actual merge happens here
+        merged_user, errors, warnings = merge_users(user1, user2)
+        self.assertEqual(errors, [])
+        self.assertEqual(warnings, [])
+        handled_attrs = set(merged_user.keys())
+
+        actual_attrs = handled_attrs | _ADDITIONAL_HANDLED
+
+        self.assertEqual(expected_attrs, actual_attrs)
+
+
+class MergeUsersTestMixin:
+    # sets up main_user and other_user so that they can be merged without errors
+    @classmethod
+    def setUpTestData(cls):
+        cls.user1 = baker.prepare(UserProfile, email="test1@institution.example.com")
+        cls.user2 = baker.prepare(UserProfile, email="test2@institution.example.com")
+        cls.user3 = baker.prepare(UserProfile, email="test3@institution.example.com")
+        cls.main_user = baker.prepare(
             UserProfile,
             title="Dr.",
             first_name_given="Main",
             first_name_chosen="",
             last_name="",
             email=None,  # test that merging works when taking the email from other user (UniqueConstraint)
-            groups=[cls.group1],
-            delegates=[cls.user1, cls.user2],
-            represented_users=[cls.user3],
-            cc_users=[cls.user1],
-            ccing_users=[],
         )
-        cls.other_user = baker.make(
+        cls.other_user = baker.prepare(
             UserProfile,
             title="",
             first_name_given="Other",
             first_name_chosen="other-display-name",
             last_name="User",
             email="other@test.com",
-            groups=[cls.group2],
-            delegates=[cls.user3],
-            represented_users=[cls.user1],
-            cc_users=[],
-            ccing_users=[cls.user1, cls.user2],
             is_superuser=True,
         )
-        cls.course1 = baker.make(Course, responsibles=[cls.main_user])
-        cls.course2 = baker.make(Course, responsibles=[cls.main_user])
-        cls.course3 = baker.make(Course, responsibles=[cls.other_user])
-        cls.evaluation1 = baker.make(
-            Evaluation, course=cls.course1, name_de="evaluation1", participants=[cls.main_user, cls.other_user]
-        )  # this should make the merge fail
-        cls.evaluation2 = baker.make(
-            Evaluation, course=cls.course2, name_de="evaluation2", participants=[cls.main_user], voters=[cls.main_user]
-        )
-        cls.evaluation3 = baker.make(
-            Evaluation,
-            course=cls.course3,
-            name_de="evaluation3",
-            participants=[cls.other_user],
-            voters=[cls.other_user],
-        )
-        cls.contribution1 = baker.make(Contribution, contributor=cls.main_user, evaluation=cls.evaluation1)
-        cls.contribution2 = baker.make(
-            Contribution, contributor=cls.other_user, evaluation=cls.evaluation1
-        )  # this should make the merge fail
-        cls.contribution3 = baker.make(Contribution, contributor=cls.other_user, evaluation=cls.evaluation2)
-        cls.rewardpointgranting_main = baker.make(RewardPointGranting, user_profile=cls.main_user)
-        cls.rewardpointgranting_other = baker.make(RewardPointGranting, user_profile=cls.other_user)
-        cls.rewardpointredemption_main = baker.make(RewardPointRedemption, user_profile=cls.main_user)
-        cls.rewardpointredemption_other = baker.make(RewardPointRedemption, user_profile=cls.other_user)
+        UserProfile.objects.bulk_create([cls.user1, cls.user2, cls.user3, cls.main_user, cls.other_user])
 
-    def test_merge_handles_all_attributes(self):
-        user1 = baker.make(UserProfile)
-        user2 = baker.make(UserProfile)
+        cls.group1 = Group.objects.get(name="Reviewer")
+        cls.group2 = Group.objects.get(name="Grade publisher")
+        UserGroups = UserProfile.groups.through
+        UserGroups.objects.bulk_create(
+            [
+                UserGroups(userprofile=cls.main_user, group=cls.group1),
+                UserGroups(userprofile=cls.other_user, group=cls.group2),
+            ]
+        )
 
-        all_attrs = list(field.name for field in UserProfile._meta.get_fields(include_hidden=True))
+        Delegates = UserProfile.delegates.through
+        Delegates.objects.bulk_create(
+            [
+                Delegates(from_userprofile=cls.main_user, to_userprofile=cls.user1),
+                Delegates(from_userprofile=cls.main_user, to_userprofile=cls.user2),
+                Delegates(from_userprofile=cls.user3, to_userprofile=cls.main_user),
+                Delegates(from_userprofile=cls.other_user, to_userprofile=cls.user3),
+                Delegates(from_userprofile=cls.user1, to_userprofile=cls.other_user),
+            ]
+        )
+        CCUsers = UserProfile.cc_users.through
+        CCUsers.objects.bulk_create(
+            [
+                CCUsers(from_userprofile=cls.main_user, to_userprofile=cls.user1),
+                CCUsers(from_userprofile=cls.user1, to_userprofile=cls.other_user),
+                CCUsers(from_userprofile=cls.user2, to_userprofile=cls.other_user),
+            ]
+        )
 
-        # these are relations to intermediate models generated by django for m2m relations.
-        # we can safely ignore these since the "normal" fields of the m2m relations are present as well.
-        all_attrs = list(attr for attr in all_attrs if not attr.startswith("UserProfile_"))
+        cls.course1, cls.course2, cls.course3 = Course.objects.bulk_create(
+            [baker.prepare(Course, _save_related=True) for __ in range(3)]
+        )
+        Responsibles = Course.responsibles.through
+        Responsibles.objects.bulk_create(
+            [
+                Responsibles(course=cls.course1, userprofile=cls.main_user),
+                Responsibles(course=cls.course2, userprofile=cls.main_user),
+                Responsibles(course=cls.course3, userprofile=cls.other_user),
+            ]
+        )
 
-        # equally named fields are not supported, sorry
-        self.assertEqual(len(all_attrs), len(set(all_attrs)))
-
-        # some attributes we don't care about when merging
-        ignored_attrs = {
-            "id",  # nothing to merge here
-            "password",  # not used in production
-            "last_login",  # something to really not care about
-            "user_permissions",  # we don't use permissions
-            "logentry",  # wtf
-            "login_key",  # we decided to discard other_user's login key
-            "login_key_valid_until",  # not worth dealing with
-            "language",  # Not worth dealing with
-            "Evaluation_voters+",  # some more intermediate models, for an explanation see above
-            "Evaluation_participants+",  # intermediate model
-            "startpage",  # not worth dealing with
-        }
-        expected_attrs = set(all_attrs) - ignored_attrs
+        # Evaluation.save() creates the general contribution, so these can't be bulk-created
+        cls.evaluation1 = baker.make(Evaluation, course=cls.course1, name_de="evaluation1")
+        cls.evaluation2 = baker.make(Evaluation, course=cls.course2, name_de="evaluation2")
+        cls.evaluation3 = baker.make(Evaluation, course=cls.course3, name_de="evaluation3")
+        Participants = Evaluation.participants.through
+        Participants.objects.bulk_create(
+            [
+                Participants(evaluation=cls.evaluation1, userprofile=cls.main_user),
+                Participants(evaluation=cls.evaluation2, userprofile=cls.main_user),
+                Participants(evaluation=cls.evaluation3, userprofile=cls.other_user),
+            ]
+        )
+        Voters = Evaluation.voters.through
+        Voters.objects.bulk_create(
+            [
+                Voters(evaluation=cls.evaluation2, userprofile=cls.main_user),
+                Voters(evaluation=cls.evaluation3, userprofile=cls.other_user),
+            ]
+        )
 
-        # actual merge happens here
-        merged_user, errors, warnings = merge_users(user1, user2)
-        self.assertEqual(errors, [])
-        self.assertEqual(warnings, [])
-        handled_attrs = set(merged_user.keys())
+        cls.contribution1, cls.contribution3 = Contribution.objects.bulk_create(
+            [
+                Contribution(contributor=cls.main_user, evaluation=cls.evaluation1),
+                Contribution(contributor=cls.other_user, evaluation=cls.evaluation2),
+            ]
+        )
 
-        # attributes that are handled in the merge method but that are not present in the merged_user dict
-        # add attributes here only if you're actually dealing with them in merge_users().
-        additional_handled_attrs = {
-            "grades_last_modified_user+",
-            "Course_responsibles+",
-        }
+        cls.rewardpointgranting_main = baker.make(RewardPointGranting, user_profile=cls.main_user)
+        cls.rewardpointgranting_other = baker.make(RewardPointGranting, user_profile=cls.other_user)
+        cls.rewardpointredemption_main = baker.make(RewardPointRedemption, user_profile=cls.main_user)
+        cls.rewardpointredemption_other = baker.make(RewardPointRedemption, user_profile=cls.other_user)
 
-        actual_attrs = handled_attrs | additional_handled_attrs
 
-        self.assertEqual(expected_attrs, actual_attrs)
+class MergeUsersFailTest(MergeUsersTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        # both of these should make the merge fail
+        cls.evaluation1.participants.add(cls.other_user)
+        cls.contribution2 = baker.make(Contribution, contributor=cls.other_user, evaluation=cls.evaluation1)
 
     def test_merge_users_does_not_change_data_on_fail(self):
         with assert_no_database_modifications():
             __, errors, warnings = merge_users(self.main_user, self.other_user)  # merge should fail
 
-        self.assertCountEqual(errors, ["contributions", "evaluations_participating_in"])
-        self.assertCountEqual(warnings, ["rewards"])
+        self.assertEqual(set(errors), {"contributions", "evaluations_participating_in"})
+        self.assertEqual(warnings, ["rewards"])
 
-    def test_merge_users_changes_data_on_success(self):
-        # Fix data so that the merge will not fail as in test_merge_users_does_not_change_data_on_fail
-        self.evaluation1.participants.set([self.main_user])
-        self.contribution2.delete()
 
+class MergeUsersSuccessTest(MergeUsersTestMixin, TestCase):
+    def test_merge_users_changes_data_on_success(self):
         __, errors, warnings = merge_users(self.main_user, self.other_user)  # merge should succeed
         self.assertEqual(errors, [])
         self.assertEqual(warnings, ["rewards"])  # rewards warning is still there
 
-        self.main_user.refresh_from_db()
-
-        self.assertEqual(self.main_user.title, "Dr.")
-        self.assertEqual(self.main_user.first_name_given, "Main")
-        self.assertEqual(self.main_user.first_name_chosen, "other-display-name")
-        self.assertEqual(self.main_user.last_name, "User")
-        self.assertEqual(self.main_user.email, "other@test.com")
-        self.assertTrue(self.main_user.is_superuser)
-        self.assertEqual(set(self.main_user.groups.all()), {self.group1, self.group2})
-        self.assertEqual(set(self.main_user.delegates.all()), {self.user1, self.user2, self.user3})
-        self.assertEqual(set(self.main_user.represented_users.all()), {self.user1, self.user3})
-        self.assertEqual(set(self.main_user.cc_users.all()), {self.user1})
-        self.assertEqual(set(self.main_user.ccing_users.all()), {self.user1, self.user2})
-        self.assertTrue(RewardPointGranting.objects.filter(user_profile=self.main_user).exists())
-        self.assertTrue(RewardPointRedemption.objects.filter(user_profile=self.main_user).exists())
-
-        self.assertEqual(set(self.course1.responsibles.all()), {self.main_user})
-        self.assertEqual(set(self.course2.responsibles.all()), {self.main_user})
-        self.assertEqual(set(self.course2.responsibles.all()), {self.main_user})
-        self.assertEqual(set(self.evaluation1.participants.all()), {self.main_user})
-        self.assertEqual(set(self.evaluation2.participants.all()), {self.main_user})
-        self.assertEqual(set(self.evaluation2.voters.all()), {self.main_user})
-        self.assertEqual(set(self.evaluation3.participants.all()), {self.main_user})
-        self.assertEqual(set(self.evaluation3.voters.all()), {self.main_user})
+        main_user = UserProfile.objects.prefetch_related(
+            "groups", "delegates", "represented_users", "cc_users", "ccing_users"
+        ).get(pk=self.main_user.pk)
+        courses = Course.objects.prefetch_related("responsibles").in_bulk(
+            [self.course1.pk, self.course2.pk, self.course3.pk]
+        )
+        evaluations = Evaluation.objects.prefetch_related("participants", "voters").in_bulk(
+            [self.evaluation1.pk, self.evaluation2.pk, self.evaluation3.pk]
+        )
+
+        self.assertEqual(main_user.title, "Dr.")
+        self.assertEqual(main_user.first_name_given, "Main")
+        self.assertEqual(main_user.first_name_chosen, "other-display-name")
+        self.assertEqual(main_user.last_name, "User")
+        self.assertEqual(main_user.email, "other@test.com")
+        self.assertTrue(main_user.is_superuser)
+        self.assertEqual(set(main_user.groups.all()), {self.group1, self.group2})
+        self.assertEqual(set(main_user.delegates.all()), {self.user1, self.user2, self.user3})
+        self.assertEqual(set(main_user.represented_users.all()), {self.user1, self.user3})
+        self.assertEqual(set(main_user.cc_users.all()), {self.user1})
+        self.assertEqual(set(main_user.ccing_users.all()), {self.user1, self.user2})
+
+        # main_user keeps its rewards, other_user is deleted together with its rewards
+        reward_counts = (
+            UserProfile.objects.filter(pk__in=[self.main_user.pk, self.other_user.pk])
+            .annotate(
+                grantings=Count("reward_point_grantings", distinct=True),
+                redemptions=Count("reward_point_redemptions", distinct=True),
+            )
+            .values_list("pk", "grantings", "redemptions")
+        )
+        self.assertEqual(list(reward_counts), [(self.main_user.pk, 1, 1)])
+
+        self.assertEqual(set(courses[self.course1.pk].responsibles.all()), {self.main_user})
+        self.assertEqual(set(courses[self.course2.pk].responsibles.all()), {self.main_user})
+        self.assertEqual(set(courses[self.course3.pk].responsibles.all()), {self.main_user})
+        self.assertEqual(set(evaluations[self.evaluation1.pk].participants.all()), {self.main_user})
+        self.assertEqual(set(evaluations[self.evaluation2.pk].participants.all()), {self.main_user})
+        self.assertEqual(set(evaluations[self.evaluation2.pk].voters.all()), {self.main_user})
+        self.assertEqual(set(evaluations[self.evaluation3.pk].participants.all()), {self.main_user})
+        self.assertEqual(set(evaluations[self.evaluation3.pk].voters.all()), {self.main_user})
 
         self.assertFalse(UserProfile.objects.filter(email="other_user@institution.example.com").exists())
-        self.assertFalse(RewardPointGranting.objects.filter(user_profile__email=self.other_user.email).exists())
-        self.assertFalse(RewardPointRedemption.objects.filter(user_profile__email=self.other_user.email).exists())
 
 
 class RemoveUserFromRepresentedAndCCingUsersTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.delete_user, cls.delete_user2, cls.user1, cls.user2 = baker.make(
+            UserProfile, _quantity=4, _bulk_create=True
+        )
+
+        Delegates = UserProfile.delegates.through
+        Delegates.objects.bulk_create(
+            [
+                Delegates(from_userprofile=cls.user1, to_userprofile=cls.delete_user),
+                Delegates(from_userprofile=cls.user1, to_userprofile=cls.delete_user2),
+                Delegates(from_userprofile=cls.user2, to_userprofile=cls.delete_user),
+            ]
+        )
+        CCUsers = UserProfile.cc_users.through
+        CCUsers.objects.bulk_create(
+            [
+                CCUsers(from_userprofile=cls.user1, to_userprofile=cls.delete_user),
+                CCUsers(from_userprofile=cls.user2, to_userprofile=cls.delete_user),
+                CCUsers(from_userprofile=cls.user2, to_userprofile=cls.delete_user2),
+            ]
+        )
+
     def test_remove_user_from_represented_and_ccing_users(self):
-        delete_user = baker.make(UserProfile)
-        delete_user2 = baker.make(UserProfile)
-        user1 = baker.make(UserProfile, delegates=[delete_user, delete_user2], cc_users=[delete_user])
-        user2 = baker.make(UserProfile, delegates=[delete_user], cc_users=[delete_user, delete_user2])
-
-        messages = remove_user_from_represented_and_ccing_users(delete_user)
-        self.assertEqual([set(user1.delegates.all()), set(user1.cc_users.all())], [{delete_user2}, set()])
-        self.assertEqual([set(user2.delegates.all()), set(user2.cc_users.all())], [set(), {delete_user2}])
+        messages = remove_user_from_represented_and_ccing_users(self.delete_user)
+        self.assertEqual(
+            [set(self.user1.delegates.all()), set(self.user1.cc_users.all())], [{self.delete_user2}, set()]
+        )
+        self.assertEqual(
+            [set(self.user2.delegates.all()), set(self.user2.cc_users.all())], [set(), {self.delete_user2}]
+        )
         self.assertEqual(len(messages), 4)
 
-        messages2 = remove_user_from_represented_and_ccing_users(delete_user2)
-        self.assertEqual([set(user1.delegates.all()), set(user1.cc_users.all())], [set(), set()])
-        self.assertEqual([set(user2.delegates.all()), set(user2.cc_users.all())], [set(), set()])
+        messages2 = remove_user_from_represented_and_ccing_users(self.delete_user2)
+        self.assertEqual([set(self.user1.delegates.all()), set(self.user1.cc_users.all())], [set(), set()])
+        self.assertEqual([set(self.user2.delegates.all()), set(self.user2.cc_users.all())], [set(), set()])
         self.assertEqual(len(messages2), 2)
 
     def test_do_not_remove_from_ignored_users(self):
-        delete_user = baker.make(UserProfile)
-        user1 = baker.make(UserProfile, delegates=[delete_user], cc_users=[delete_user])
-        user2 = baker.make(UserProfile, delegates=[delete_user], cc_users=[delete_user])
-
-        messages = remove_user_from_represented_and_ccing_users(delete_user, [user2])
-        self.assertEqual([set(user1.delegates.all()), set(user1.cc_users.all())], [set(), set()])
-        self.assertEqual([set(user2.delegates.all()), set(user2.cc_users.all())], [{delete_user}, {delete_user}])
+        messages = remove_user_from_represented_and_ccing_users(self.delete_user, [self.user2])
+        self.assertEqual(
+            [set(self.user1.delegates.all()), set(self.user1.cc_users.all())], [{self.delete_user2}, set()]
+        )
+        self.assertEqual(
+            [set(self.user2.delegates.all()), set(self.user2.cc_users.all())],
+            [{self.delete_user}, {self.delete_user, self.delete_user2}],
+        )
         self.assertEqual(len(messages), 2)
 
     def test_do_nothing_if_test_run(self):
-        delete_user = baker.make(UserProfile)
-        user1 = baker.make(UserProfile, delegates=[delete_user], cc_users=[delete_user])
-        user2 = baker.make(UserProfile, delegates=[delete_user], cc_users=[delete_user])
-
-        messages = remove_user_from_represented_and_ccing_users(delete_user, test_run=True)
-        self.assertEqual([set(user1.delegates.all()), set(user1.cc_users.all())], [{delete_user}, {delete_user}])
-        self.assertEqual([set(user2.delegates.all()), set(user2.cc_users.all())], [{delete_user}, {delete_user}])
+        messages = remove_user_from_represented_and_ccing_users(self.delete_user, test_run=True)
+        self.assertEqual(
+            [set(self.user1.delegates.all()), set(self.user1.cc_users.all())],
+            [{self.delete_user, self.delete_user2}, {self.delete_user}],
+        )
+        self.assertEqual(
+            [set(self.user2.delegates.all()), set(self.user2.cc_users.all())],
+            [{self.delete_user}, {self.delete_user, self.delete_user2}],
+        )
         self.assertEqual(len(messages), 4)
 
 